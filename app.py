@@ -1,46 +1,109 @@
 import os
+import re
 import uuid
-import json
-import qrcode
-from qrcode import QRCode
+import orjson
+import functools
+import hashlib
 import logging
 import threading
 import time
-from datetime import datetime
+import tempfile
+import heapq
+import itertools
+import multiprocessing
 from io import BytesIO
-from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for
-from werkzeug.utils import secure_filename
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, render_template, request, jsonify, send_file, flash, redirect, url_for
+from flask.json.provider import JSONProvider
 from werkzeug.middleware.proxy_fix import ProxyFix
-from weasyprint import HTML, CSS
+from jinja2 import FileSystemBytecodeCache
+import pdf_renderer
 
 logging.basicConfig(level=logging.DEBUG)
 
+class OrjsonProvider(JSONProvider):
+    """Serve jsonify() and request.get_json() through orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+# Development mode: enables the Flask dev server and gunicorn's auto-reload
+DEV = os.environ.get("DEV") == "1"
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+app.json = OrjsonProvider(app)
 
-# Custom template filter for currency formatting
-@app.template_filter('currency')
-def currency_filter(value):
-    """Format currency with thousands separator"""
-    try:
-        return "{:,.2f}".format(float(value))
-    except (ValueError, TypeError):
-        return "0.00"
+# Cache compiled template bytecode on disk so restarted/forked workers skip
+# re-parsing and re-compiling index.html (receipt_pdf.html is compiled by the
+# render processes, see pdf_renderer). With no folder given, Jinja uses a
+# per-user temp folder (mode 0700) and checks its owner.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 
 # Configure upload settings
 UPLOAD_FOLDER = 'static/uploads'
-QR_FOLDER = 'static/qr'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'svg'}
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+SAFE_NAME = re.compile(r'[A-Za-z0-9_-][A-Za-z0-9._-]{0,63}')  # no separators or leading dot
+LOGO_NAME = re.compile(r'[0-9a-f]{16}\.(?:%s)' % '|'.join(ALLOWED_EXTENSIONS))  # as named by upload_logo()
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['QR_FOLDER'] = QR_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Let the front-end server stream files from disk (send_file then only emits an
+# X-Sendfile header). Enable only behind a server that honours it, such as Apache
+# with mod_xsendfile or lighttpd; nginx ignores X-Sendfile.
+app.use_x_sendfile = os.environ.get('USE_X_SENDFILE') == '1'
+
 # Create directories if they don't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(QR_FOLDER, exist_ok=True)
+
+# Receipts are rendered in a pool of separate processes, so several PDFs can
+# be laid out at once instead of taking turns on one interpreter's GIL. The
+# pool belongs to the serving worker rather than gunicorn's preloading
+# master: gunicorn.conf.py starts it when the worker boots (the development
+# server creates it on first use). RENDER_PROCESSES overrides the pool
+# size, which otherwise follows the CPUs this process may run on, capped at
+# MAX_RENDER_PROCESSES (containers often report the host's full CPU count).
+MAX_RENDER_PROCESSES = 4
+
+def default_render_processes():
+    """Number of render processes to start when RENDER_PROCESSES is unset"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS/Windows
+        cpus = os.cpu_count() or 1
+    return min(cpus, MAX_RENDER_PROCESSES)
+
+RENDER_PROCESSES = int(os.environ.get("RENDER_PROCESSES", 0)) or default_render_processes()
+receipt_executor = None
+receipt_executor_lock = threading.Lock()
+jobs = {}  # job_id -> {'future': render Future, 'event': final progress event or None}
+
+# How long the browser waits before asking /progress/<job_id> again. Each
+# progress response returns straight away; EventSource reconnects after this
+# delay until it receives 'done' or 'error', so waiting for a render never
+# holds a request thread.
+PROGRESS_RETRY_MS = 500
+
+# Generated PDFs are held in memory until downloaded or expired
+RECEIPT_TTL_SECONDS = 60
+receipt_store = {}  # receipt_id -> (expiry time, PDF bytes)
+receipt_store_lock = threading.Lock()
+
+# A single janitor thread runs delayed cleanups in expiry order. It is
+# started on first use so it lives in the serving process, not a
+# pre-fork parent.
+JOB_TTL_SECONDS = 600
+cleanup_heap = []  # (due time, sequence, callback, args)
+cleanup_sequence = itertools.count()
+cleanup_cond = threading.Condition()
+cleanup_thread = None
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -49,29 +112,67 @@ def generate_receipt_id():
     """Generate a unique receipt ID"""
     return f"RCP-{str(uuid.uuid4())[:8].upper()}"
 
-def delete_file_after_delay(file_path, delay_seconds=60):
-    """Delete a file after a specified delay"""
-    def delete_file():
+def run_cleanups():
+    """Janitor loop: sleep until the earliest scheduled cleanup is due, then run it"""
+    while True:
+        with cleanup_cond:
+            while True:
+                now = time.monotonic()
+                if cleanup_heap and cleanup_heap[0][0] <= now:
+                    _, _, callback, args = heapq.heappop(cleanup_heap)
+                    break
+                cleanup_cond.wait(timeout=cleanup_heap[0][0] - now if cleanup_heap else None)
         try:
-            time.sleep(delay_seconds)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logging.info(f"Deleted file: {file_path}")
+            callback(*args)
         except Exception as e:
-            logging.error(f"Error deleting file {file_path}: {e}")
-    
-    # Run deletion in a separate thread
-    thread = threading.Thread(target=delete_file, daemon=True)
-    thread.start()
+            logging.error(f"Error running scheduled cleanup: {e}")
+
+def schedule_cleanup(delay_seconds, callback, *args):
+    """Run callback(*args) on the janitor thread after delay_seconds"""
+    global cleanup_thread
+    with cleanup_cond:
+        heapq.heappush(cleanup_heap, (time.monotonic() + delay_seconds, next(cleanup_sequence), callback, args))
+        if cleanup_thread is None or not cleanup_thread.is_alive():
+            cleanup_thread = threading.Thread(target=run_cleanups, name='cleanup', daemon=True)
+            cleanup_thread.start()
+        cleanup_cond.notify()
+
+def store_receipt_pdf(receipt_id, pdf_bytes, ttl_seconds=RECEIPT_TTL_SECONDS):
+    """Keep a generated PDF in memory for download until its TTL runs out"""
+    with receipt_store_lock:
+        receipt_store[receipt_id] = (time.monotonic() + ttl_seconds, pdf_bytes)
+    schedule_cleanup(ttl_seconds, expire_receipt_pdf, receipt_id)
+
+def expire_receipt_pdf(receipt_id):
+    """Drop a stored PDF once expired (a regenerated receipt keeps its newer copy)"""
+    with receipt_store_lock:
+        entry = receipt_store.get(receipt_id)
+        if entry is not None and entry[0] <= time.monotonic():
+            del receipt_store[receipt_id]
+            logging.info(f"Expired receipt PDF: {receipt_id}")
+
+def get_receipt_pdf(receipt_id):
+    """Return the stored PDF bytes for a receipt, or None if missing or expired"""
+    with receipt_store_lock:
+        entry = receipt_store.get(receipt_id)
+    if entry is None or entry[0] <= time.monotonic():
+        return None
+    return entry[1]
+
+# Parsed currency list, kept once it has loaded successfully
+currencies_cache = None
 
 def load_currencies():
-    """Load currency data from JSON file"""
-    try:
-        with open('static/currencies.json', 'r') as f:
-            return json.load(f)
-    except Exception as e:
-        logging.error(f"Error loading currencies: {e}")
-        return [{"code": "USD", "symbol": "$", "name": "US Dollar"}]
+    """Load currency data from JSON file (cached after the first successful parse)"""
+    global currencies_cache
+    if currencies_cache is None:
+        try:
+            with open(os.path.join(app.static_folder, 'currencies.json'), 'rb') as f:
+                currencies_cache = orjson.loads(f.read())
+        except Exception as e:
+            logging.error(f"Error loading currencies: {e}")
+            return [{"code": "USD", "symbol": "$", "name": "US Dollar"}]
+    return currencies_cache
 
 @app.route('/')
 def index():
@@ -88,136 +189,141 @@ def upload_logo():
         return jsonify({'error': 'No file selected'}), 400
     
     if file and file.filename and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        # Add timestamp to prevent overwrites
-        name, ext = os.path.splitext(filename)
-        filename = f"{name}_{int(datetime.now().timestamp())}{ext}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        # Name the file after its content so repeat uploads of a logo share one file.
+        # Hash while copying to a temporary file in 1MB chunks, then move it into place.
+        digest = hashlib.blake2b(digest_size=8)
+        ext = file.filename.rsplit('.', 1)[1].lower()  # checked by allowed_file()
+        out = tempfile.NamedTemporaryFile(dir=UPLOAD_FOLDER, suffix='.part', delete=False)
+        try:
+            with out:
+                while chunk := file.stream.read(UPLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    out.write(chunk)
+            
+            filename = f"{digest.hexdigest()}.{ext}"
+            filepath = f"{UPLOAD_FOLDER}/{filename}"
+            if not os.path.exists(filepath):
+                os.chmod(out.name, 0o644)  # temp files are created owner-only
+                os.replace(out.name, filepath)
+        finally:
+            # Never leave a partial upload in the publicly served folder
+            if os.path.exists(out.name):
+                os.remove(out.name)
         return jsonify({'filename': filename, 'url': f'/static/uploads/{filename}'})
     
     return jsonify({'error': 'Invalid file type'}), 400
 
+def new_receipt_executor():
+    """Create the render process pool; each process warms up WeasyPrint as it starts"""
+    return ProcessPoolExecutor(
+        max_workers=RENDER_PROCESSES,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=pdf_renderer.init_pdf_renderer
+    )
+
+def start_receipt_renderers():
+    """Start every render process now so none warms up during a receipt request"""
+    global receipt_executor
+    with receipt_executor_lock:
+        if receipt_executor is None:
+            receipt_executor = new_receipt_executor()
+            # A spawn pool only starts a process when a task finds no idle
+            # one, so queue one no-op per process
+            for _ in range(RENDER_PROCESSES):
+                receipt_executor.submit(os.getpid)
+
+def submit_receipt_render(data, host_url):
+    """Queue a receipt on the render process pool, replacing the pool if it has broken"""
+    global receipt_executor
+    with receipt_executor_lock:
+        if receipt_executor is not None:
+            try:
+                return receipt_executor.submit(pdf_renderer.render_receipt, data, host_url)
+            except BrokenProcessPool:
+                logging.warning("Receipt render pool broke; starting a new one")
+        receipt_executor = new_receipt_executor()
+        return receipt_executor.submit(pdf_renderer.render_receipt, data, host_url)
+
+def finish_receipt_job(job, receipt_id, future):
+    """Render callback: keep the finished PDF and record the job's final event"""
+    error = future.exception()
+    if error is None:
+        # Available for download for 1 minute
+        store_receipt_pdf(receipt_id, future.result())
+        job['event'] = {'stage': 'done', 'success': True, 'receipt_id': receipt_id}
+    else:
+        logging.error(f"Error generating receipt: {error}")
+        job['event'] = {'stage': 'error', 'error': str(error)}
+
 @app.route('/generate_receipt', methods=['POST'])
 def generate_receipt():
     try:
         # Get form data
         data = request.get_json()
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Invalid receipt data'}), 400
         
-        # Ensure items is a proper list and calculate totals
-        items_data = data.get('items', [])
-        if not isinstance(items_data, list):
-            data['items'] = []
-        else:
-            data['items'] = items_data
-        
-        # Calculate subtotal, tax, and grand total if not provided
-        if 'subtotal' not in data or 'tax_amount' not in data or 'grand_total' not in data:
-            subtotal = sum(float(item.get('quantity', 0)) * float(item.get('price', 0)) for item in data['items'])
-            tax_rate = float(data.get('tax_rate', 0))
-            discount = float(data.get('discount', 0))
-            tax_amount = (subtotal * tax_rate) / 100
-            grand_total = subtotal + tax_amount - discount
-            
-            data['subtotal'] = "{:.2f}".format(subtotal)
-            data['tax_amount'] = "{:.2f}".format(tax_amount)
-            data['grand_total'] = "{:.2f}".format(max(0, grand_total))
-        
-        # Set default values for missing fields
-        data.setdefault('payment_status', 'Pending')
-        data.setdefault('date', datetime.now().strftime('%Y-%m-%d'))
-        data.setdefault('currency_code', 'USD')
-        data.setdefault('currency_symbol', '$')
-        data.setdefault('tax_rate', '0')
-        data.setdefault('discount', '0')
-        data.setdefault('notes', '')
-        
-        # Generate QR code with receipt summary
-        qr_data = {
-            'receipt_id': data.get('receipt_id'),
-            'business_name': data.get('business_name'),
-            'client_name': data.get('client_name'),
-            'total': data.get('grand_total'),
-            'date': data.get('date'),
-            'status': data.get('payment_status')
-        }
-        
-        qr_filename = f"qr_{data.get('receipt_id')}.png"
-        qr_path = os.path.join(app.config['QR_FOLDER'], qr_filename)
-        
-        qr = QRCode(version=1, box_size=10, border=5)
-        qr.add_data(json.dumps(qr_data))
-        qr.make(fit=True)
-        
-        qr_img = qr.make_image(fill_color="black", back_color="white")
-        qr_img.save(qr_path)
-        
-        # Add QR code path to data
-        data['qr_code_path'] = os.path.abspath(qr_path)
-        
-        # Convert logo filename to absolute path for PDF generation
-        if data.get('logo_filename'):
-            logo_path = os.path.join(app.config['UPLOAD_FOLDER'], data['logo_filename'])
-            data['logo_absolute_path'] = os.path.abspath(logo_path)
-        
-        # Generate PDF
-        html_content = render_template('receipt_pdf.html', data=data)
+        # The receipt ID keys the stored PDF and its download URL
+        receipt_id = data.get('receipt_id')
+        if not isinstance(receipt_id, str) or not SAFE_NAME.fullmatch(receipt_id):
+            return jsonify({'error': 'Invalid receipt ID'}), 400
         
-        # Generate PDF using WeasyPrint
-        pdf_filename = f"receipt_{data.get('receipt_id')}.pdf"
-        pdf_path = os.path.join('static', pdf_filename)
+        # The logo is read from disk by path, so only accept names upload_logo() produces
+        logo_filename = data.get('logo_filename')
+        if logo_filename and (not isinstance(logo_filename, str) or not LOGO_NAME.fullmatch(logo_filename)):
+            return jsonify({'error': 'Invalid logo'}), 400
         
-        # Create HTML object and generate PDF
-        html_doc = HTML(string=html_content, base_url=request.host_url)
-        html_doc.write_pdf(pdf_path)
+        # Hand the slow QR/PDF work to the render pool and return immediately
+        job_id = uuid.uuid4().hex
+        job = {'future': submit_receipt_render(data, request.host_url), 'event': None}
+        jobs[job_id] = job
+        job['future'].add_done_callback(functools.partial(finish_receipt_job, job, receipt_id))
         
-        # Schedule automatic deletion of generated files after 1 minute
-        delete_file_after_delay(pdf_path, 60)
-        delete_file_after_delay(qr_path, 60)
+        # Forget the job even if the browser never asks for its progress
+        schedule_cleanup(JOB_TTL_SECONDS, jobs.pop, job_id, None)
         
-        return jsonify({
-            'success': True,
-            'receipt_id': data.get('receipt_id'),
-            'pdf_filename': pdf_filename,
-            'qr_url': data['qr_code_path']
-        })
+        return jsonify({'job_id': job_id}), 202
         
     except Exception as e:
-        logging.error(f"Error generating receipt: {e}")
+        logging.error(f"Error queueing receipt: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/download_pdf/<filename>')
-def download_pdf(filename):
-    try:
-        # Validate filename to prevent directory traversal
-        if not filename or '..' in filename or '/' in filename:
-            return jsonify({'error': 'Invalid filename'}), 400
-            
-        pdf_path = os.path.join('static', filename)
-        
-        # Check if file exists
-        if not os.path.exists(pdf_path):
-            return jsonify({'error': 'File not found'}), 404
-            
-        return send_file(pdf_path, as_attachment=True, download_name=filename)
-    except Exception as e:
-        logging.error(f"Error downloading PDF: {e}")
-        return jsonify({'error': 'Error downloading PDF file'}), 500
+@app.route('/progress/<job_id>')
+def receipt_progress(job_id):
+    """Report a receipt job's current stage as a Server-Sent Event"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    event = job['event']
+    if event is None:
+        event = {'stage': 'pdf' if job['future'].running() else 'queued'}
+    else:
+        jobs.pop(job_id, None)
+    
+    return Response(
+        f"retry: {PROGRESS_RETRY_MS}\n".encode('ascii') + b"data: " + orjson.dumps(event) + b"\n\n",
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'}
+    )
 
 @app.route('/download_receipt/<receipt_id>')
 def download_receipt(receipt_id):
     try:
         # Validate receipt_id to prevent directory traversal
-        if not receipt_id or '..' in receipt_id or '/' in receipt_id:
+        if not SAFE_NAME.fullmatch(receipt_id):
             return jsonify({'error': 'Invalid receipt ID'}), 400
             
-        pdf_filename = f"receipt_{receipt_id}.pdf"
-        pdf_path = os.path.join('static', pdf_filename)
-        
-        if os.path.exists(pdf_path):
-            return send_file(pdf_path, as_attachment=True, download_name=pdf_filename)
-        else:
+        pdf_bytes = get_receipt_pdf(receipt_id)
+        if pdf_bytes is None:
             return jsonify({'error': 'Receipt file not found'}), 404
+        
+        return send_file(
+            BytesIO(pdf_bytes),
+            mimetype='application/pdf',
+            as_attachment=True,
+            download_name=f"receipt_{receipt_id}.pdf"
+        )
     except Exception as e:
         logging.error(f"Error downloading receipt: {e}")
         return jsonify({'error': 'Error downloading receipt file'}), 500
@@ -235,8 +341,7 @@ def export_business_settings():
         }
         
         # Create JSON file
-        json_content = json.dumps(business_data, indent=2)
-        json_buffer = BytesIO(json_content.encode('utf-8'))
+        json_buffer = BytesIO(orjson.dumps(business_data, option=orjson.OPT_INDENT_2))
         json_buffer.seek(0)
         
         return send_file(
@@ -250,5 +355,12 @@ def export_business_settings():
         logging.error(f"Error exporting business settings: {e}")
         return jsonify({'error': str(e)}), 500
 
+# Parse the index template and currency list up front so gunicorn's preloaded
+# master forks workers that serve their first request from warm caches
+app.jinja_env.get_template('index.html')
+load_currencies()
+
 if __name__ == "__main__":
+    if not DEV:
+        raise SystemExit("The Flask development server only runs with DEV=1; use gunicorn in production")
     app.run(host="0.0.0.0", port=5000, debug=True)
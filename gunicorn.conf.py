@@ -0,0 +1,31 @@
+# Gunicorn configuration for Smart Receipt Generator
+# Picked up automatically when gunicorn is started from the project root,
+# e.g. `gunicorn main:app`.
+import os
+
+bind = "0.0.0.0:5000"
+
+# Receipt jobs and finished PDFs live in the worker process that accepted
+# them (see app.jobs), so /progress and /download_receipt must be served by
+# that same process: run one worker. PDF rendering still uses every core,
+# because the worker hands it to a pool of render processes
+# (app.receipt_executor). Request threads only serve short requests; the
+# progress endpoint answers immediately and the browser polls it.
+workers = 1
+worker_class = "gthread"
+threads = 16
+
+def post_worker_init(worker):
+    """Start the render processes as the worker boots, before the first receipt"""
+    from app import start_receipt_renderers
+    start_receipt_renderers()
+
+# Import the app once in the master so workers fork with it already loaded.
+# Preloading stops --reload from picking up code changes, so it is switched
+# off for development (DEV=1).
+DEV = os.environ.get("DEV") == "1"
+preload_app = not DEV
+reload = DEV
+
+# Large receipts can take a while to render
+timeout = 120
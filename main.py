@@ -1,4 +1,6 @@
-from app import app
+from app import app, DEV
 
 if __name__ == "__main__":
+    if not DEV:
+        raise SystemExit("The Flask development server only runs with DEV=1; use gunicorn in production")
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,122 @@
+"""Receipt PDF rendering, run inside the render process pool.
+
+Kept apart from app.py so each spawned render process only imports what
+rendering needs (Jinja, WeasyPrint, segno) instead of re-running the Flask
+app's setup.
+"""
+import os
+import math
+import base64
+import logging
+import orjson
+import segno
+from datetime import datetime
+from io import BytesIO
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
+from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RECEIPT_CSS_PATH = os.path.join(BASE_DIR, 'static', 'receipt.css')
+
+# The PDF template links logos by absolute file path
+UPLOAD_FOLDER_PATH = os.path.join(BASE_DIR, 'static', 'uploads')
+
+def currency_filter(value):
+    """Format currency with thousands separator"""
+    try:
+        return "{:,.2f}".format(float(value))
+    except (ValueError, TypeError):
+        return "0.00"
+
+# Same autoescaping as Flask's environment; compiled bytecode is cached on
+# disk so new render processes skip re-compiling receipt_pdf.html
+jinja_env = Environment(
+    loader=FileSystemLoader(os.path.join(BASE_DIR, 'templates')),
+    autoescape=select_autoescape(['html']),
+    bytecode_cache=FileSystemBytecodeCache()
+)
+jinja_env.filters['currency'] = currency_filter
+
+# Per-process WeasyPrint state: each render process sets up font lookup and
+# parses the receipt stylesheet once (see init_pdf_renderer) and renders one
+# receipt at a time, so the font map is never shared between threads
+FONT_CONFIG = None
+BASE_CSS = None
+
+def init_pdf_renderer():
+    """Render process initializer: build the font config and stylesheet, then warm up"""
+    global FONT_CONFIG, BASE_CSS
+    FONT_CONFIG = FontConfiguration()
+    BASE_CSS = CSS(filename=RECEIPT_CSS_PATH, font_config=FONT_CONFIG)
+    jinja_env.get_template('receipt_pdf.html')
+
+    # Render a throwaway PDF so font discovery and layout setup happen before
+    # the first receipt
+    try:
+        HTML(string='<p>Receipt</p>').write_pdf(stylesheets=[BASE_CSS], font_config=FONT_CONFIG)
+    except Exception as e:
+        logging.warning(f"PDF engine warm-up failed: {e}")
+
+def render_qr_svg(payload):
+    """Render payload bytes as a base64 QR code SVG"""
+    buffer = BytesIO()
+    # One <path> for all dark modules at unit scale; the template sizes the image.
+    # No XML declaration or CSS classes are needed inside a data URI.
+    segno.make(payload, error='m').save(
+        buffer, kind='svg', scale=1, border=5,
+        xmldecl=False, svgclass=None, lineclass=None, nl=False
+    )
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def render_receipt(data, host_url):
+    """Render the QR code and PDF for a receipt"""
+    # Ensure items is a proper list and calculate totals
+    items_data = data.get('items', [])
+    if not isinstance(items_data, list):
+        data['items'] = []
+    else:
+        data['items'] = items_data
+
+    # Calculate subtotal, tax, and grand total if not provided
+    if 'subtotal' not in data or 'tax_amount' not in data or 'grand_total' not in data:
+        subtotal = math.fsum(float(item.get('quantity', 0)) * float(item.get('price', 0)) for item in data['items'])
+        tax_rate = float(data.get('tax_rate', 0))
+        discount = float(data.get('discount', 0))
+        tax_amount = (subtotal * tax_rate) / 100
+        grand_total = subtotal + tax_amount - discount
+
+        data['subtotal'] = "{:.2f}".format(subtotal)
+        data['tax_amount'] = "{:.2f}".format(tax_amount)
+        data['grand_total'] = "{:.2f}".format(max(0, grand_total))
+
+    # Set default values for missing fields
+    data.setdefault('payment_status', 'Pending')
+    data.setdefault('date', datetime.now().strftime('%Y-%m-%d'))
+    data.setdefault('currency_code', 'USD')
+    data.setdefault('currency_symbol', '$')
+    data.setdefault('tax_rate', '0')
+    data.setdefault('discount', '0')
+    data.setdefault('notes', '')
+
+    # Generate QR code with receipt summary
+    qr_data = {
+        'receipt_id': data.get('receipt_id'),
+        'business_name': data.get('business_name'),
+        'client_name': data.get('client_name'),
+        'total': data.get('grand_total'),
+        'date': data.get('date'),
+        'status': data.get('payment_status')
+    }
+
+    # Embedded straight into the PDF template as a data URI
+    data['qr_svg_b64'] = render_qr_svg(orjson.dumps(qr_data, option=orjson.OPT_SORT_KEYS))
+
+    # Convert logo filename to absolute path for PDF generation
+    if data.get('logo_filename'):
+        data['logo_absolute_path'] = os.path.join(UPLOAD_FOLDER_PATH, data['logo_filename'])
+
+    # Generate PDF using WeasyPrint, straight into memory
+    html_content = jinja_env.get_template('receipt_pdf.html').render(data=data)
+    html_doc = HTML(string=html_content, base_url=host_url)
+    return html_doc.write_pdf(stylesheets=[BASE_CSS], font_config=FONT_CONFIG)
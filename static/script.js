@@ -233,7 +233,15 @@ async function generateReceipt() {
             body: JSON.stringify(formData)
         });
         
-        const result = await response.json();
+        const job = await response.json();
+        
+        if (!response.ok) {
+            showToast('Error generating receipt: ' + job.error, 'danger');
+            return;
+        }
+        
+        // Wait for the background job to finish rendering
+        const result = await waitForReceipt(job.job_id);
         
         if (result.success) {
             // Save receipt to history
@@ -266,6 +274,40 @@ async function generateReceipt() {
     }
 }
 
+// Follow a receipt generation job via Server-Sent Events until it finishes.
+// The server answers each request immediately and EventSource reconnects
+// after the server-supplied retry delay, so a closed stream is expected.
+function waitForReceipt(jobId) {
+    const stageMessages = {
+        queued: 'Waiting for a free renderer...',
+        pdf: 'Rendering PDF...'
+    };
+    const status = document.getElementById('loadingStatus');
+    status.textContent = 'Please wait while we prepare your receipt.';
+    
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(`/progress/${jobId}`);
+        
+        source.onmessage = event => {
+            const progress = JSON.parse(event.data);
+            
+            if (progress.stage === 'done' || progress.stage === 'error') {
+                source.close();
+                resolve(progress);
+            } else if (stageMessages[progress.stage]) {
+                status.textContent = stageMessages[progress.stage];
+            }
+        };
+        
+        source.onerror = () => {
+            // CONNECTING means the browser is about to poll again
+            if (source.readyState === EventSource.CLOSED) {
+                reject(new Error('Lost connection while generating receipt'));
+            }
+        };
+    });
+}
+
 // Collect form data
 function collectFormData() {
     const data = {
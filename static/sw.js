@@ -1,4 +1,4 @@
-const CACHE_NAME = 'smart-receipt-generator-v3';
+const CACHE_NAME = 'smart-receipt-generator-v4';
 const urlsToCache = [
   '/',
   '/static/style.css',